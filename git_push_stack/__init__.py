@@ -16,11 +16,14 @@
 
 import argparse
 import asyncio
+import email.utils
+import functools
 import importlib.metadata
 import os
 import re
 import subprocess
 import sys
+import time
 import typing
 from urllib import parse
 
@@ -37,11 +40,22 @@ except ImportError:
     # https://pyoxidizer.readthedocs.io/en/stable/oxidized_importer_behavior_and_compliance.html#importlib-metadata-compatibility
     VERSION = "0.1"
 
-CHANGEID_RE = re.compile(r"Change-Id: (I[0-9a-z]{40})")
-READY_FOR_REVIEW_TEMPLATE = 'mutation { markPullRequestReadyForReview(input: { pullRequestId: "%s" }) { clientMutationId } }'
+COMMIT_MSG_HOOK_SIZE = len(COMMIT_MSG_HOOK.encode())
+CHANGEID_RE = re.compile(r"Change-Id: (I[0-9a-z]{40})", re.ASCII)
+READY_FOR_REVIEW_TEMPLATE = '%s: markPullRequestReadyForReview(input: { pullRequestId: "%s" }) { clientMutationId }'
+STACK_COMMENT_FIRST_LINE = "This pull request is part of a stack:\n"
+PULLS_BY_HEAD_TEMPLATE = "%s: pullRequests(headRefName: $%s, states: OPEN, first: 10) { nodes { id number title url state isDraft headRefOid baseRefName headRepositoryOwner { login } %s } }"
+PULL_COMMENTS_FIELD = (
+    "comments(first: 50) { pageInfo { hasNextPage } nodes { fullDatabaseId body } }"
+)
 console = rich.console.Console(log_path=False, log_time=False)
 
 DEBUG = False
+RATE_LIMIT_MAX_RETRIES = 5
+RATE_LIMIT_DEFAULT_DELAY = 60.0
+DELETE_CONCURRENCY = 8
+# Max size of one record read by git_stream()
+GIT_STREAM_LIMIT = 2**24
 
 
 def check_for_graphql_errors(response: httpx.Response) -> None:
@@ -78,22 +92,99 @@ def check_for_status(response: httpx.Response) -> None:
     response.raise_for_status()
 
 
-async def git(args: str) -> str:
+def parse_retry_after(value: str) -> float:
+    try:
+        return max(float(value), 1.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return RATE_LIMIT_DEFAULT_DELAY
+    return max(date.timestamp() - time.time(), 1.0)
+
+
+def get_rate_limit_delay(response: httpx.Response) -> float | None:
+    if response.status_code not in (403, 429):
+        return None
+    if "Retry-After" in response.headers:
+        return parse_retry_after(response.headers["Retry-After"])
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            reset = float(response.headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return RATE_LIMIT_DEFAULT_DELAY
+        return max(reset - time.time(), 1.0)
+    return None
+
+
+class RateLimitRetryTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        for _ in range(RATE_LIMIT_MAX_RETRIES):
+            response = await self.transport.handle_async_request(request)
+            delay = get_rate_limit_delay(response)
+            if delay is None:
+                return response
+            await response.aclose()
+            console.log(
+                f"GitHub rate limit reached, retrying in {delay:.0f}s", style="yellow"
+            )
+            await asyncio.sleep(delay)
+        # Give up, check_for_status() will report the error
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+async def create_git_process(
+    *args: str, **kwargs: typing.Any
+) -> asyncio.subprocess.Process:
     if DEBUG:
-        console.print(f"[purple]DEBUG: running: git {args} [/]")
-    proc = await asyncio.create_subprocess_shell(
-        f"git {args}",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
+        console.print(f"[purple]DEBUG: running: git {' '.join(args)} [/]")
+    return await asyncio.create_subprocess_exec(
+        "git", *args, stdout=asyncio.subprocess.PIPE, **kwargs
     )
+
+
+def git_failed(args: tuple[str, ...], output: bytes) -> typing.NoReturn:
+    console.log(f"fail to run `git {' '.join(args)}`:", style="red")
+    console.log(f"{output.decode()}", style="red")
+    sys.exit(1)
+
+
+async def git(*args: str) -> str:
+    proc = await create_git_process(*args, stderr=asyncio.subprocess.STDOUT)
     stdout, _ = await proc.communicate()
     if proc.returncode != 0:
-        console.log(f"fail to run `git {args}`:", style="red")
-        console.log(f"{stdout.decode()}", style="red")
-        sys.exit(1)
+        git_failed(args, stdout)
     return stdout.decode().strip()
 
 
+async def git_stream(*args: str, separator: bytes = b"\n") -> typing.AsyncIterator[str]:
+    proc = await create_git_process(
+        *args, stderr=asyncio.subprocess.PIPE, limit=GIT_STREAM_LIMIT
+    )
+    assert proc.stdout is not None
+    assert proc.stderr is not None
+    # Drain stderr concurrently, so git never blocks on a full stderr pipe
+    stderr = asyncio.create_task(proc.stderr.read())
+    while True:
+        try:
+            record = await proc.stdout.readuntil(separator)
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                yield e.partial.decode().strip()
+            break
+        yield record[: -len(separator)].decode().strip()
+    if await proc.wait() != 0:
+        git_failed(args, await stderr)
+
+
+@functools.cache
 def get_slug(url: str) -> tuple[str, str]:
     parsed = parse.urlparse(url)
     if parsed.netloc == "":
@@ -109,16 +200,17 @@ def get_slug(url: str) -> tuple[str, str]:
 
 
 async def do_setup() -> None:
-    os.chdir((await git("rev-parse --show-toplevel")).strip())
+    os.chdir((await git("rev-parse", "--show-toplevel")).strip())
     hook_file = os.path.join(".git", "hooks", "commit-msg")
     if os.path.exists(hook_file):
-        with open(hook_file, "f") as f:
-            data = f.read()
-        if data != COMMIT_MSG_HOOK:
-            console.print(
-                f"error: {hook_file} differ from git_push_stack hook", style="red"
-            )
-            sys.exit(1)
+        if os.stat(hook_file).st_size == COMMIT_MSG_HOOK_SIZE:
+            with open(hook_file) as f:
+                if f.read() == COMMIT_MSG_HOOK:
+                    return
+        console.print(
+            f"error: {hook_file} differ from git_push_stack hook", style="red"
+        )
+        sys.exit(1)
 
     else:
         console.log("Installation of git commit-msg hook")
@@ -135,11 +227,16 @@ class HeadRef(typing.TypedDict):
     sha: str
 
 
+class BaseRef(typing.TypedDict):
+    ref: str
+
+
 class PullRequest(typing.TypedDict):
     html_url: str
     number: str
     title: str
     head: HeadRef
+    base: BaseRef
     state: str
     draft: bool
     node_id: str
@@ -149,35 +246,158 @@ ChangeId = typing.NewType("ChangeId", str)
 KnownChangeIDs = typing.NewType("KnownChangeIDs", dict[ChangeId, PullRequest | None])
 
 
-async def get_changeid_and_pull(
-    client: httpx.AsyncClient, user: str, stack_prefix: str, ref: GitRef
-) -> tuple[ChangeId, PullRequest | None]:
-    branch = ref["ref"][len("refs/heads/") :]
-    changeid = ChangeId(branch[len(stack_prefix) + 1 :])
-    r = await client.get("pulls", params={"head": f"{user}:{branch}", "state": "open"})
+class Comment(typing.TypedDict):
+    url: str
+    body: str
+
+
+# None means the comments are not known and must be retrieved
+KnownComments = typing.NewType("KnownComments", dict[str, list[Comment] | None])
+
+
+async def paginate(
+    client: httpx.AsyncClient, url: str, params: dict[str, str] | None = None
+) -> typing.AsyncIterator[typing.Any]:
+    next_url: str | None = url
+    next_params: dict[str, str] | None = {"per_page": "100", **(params or {})}
+    while next_url is not None:
+        r = await client.get(next_url, params=next_params)
+        check_for_status(r)
+        for item in r.json():
+            yield item
+        # The next link already contains the query parameters
+        next_url = r.links.get("next", {}).get("url")
+        next_params = None
+
+
+async def graphql(
+    client: httpx.AsyncClient, query: str, variables: dict[str, str] | None = None
+) -> typing.Any:
+    r = await client.post(
+        "https://api.github.com/graphql",
+        headers={
+            "Accept": "application/vnd.github.v4.idl",
+            "User-Agent": f"git_push_stack/{VERSION}",
+            "Authorization": client.headers["Authorization"],
+        },
+        json={"query": query, "variables": variables or {}},
+    )
     check_for_status(r)
-    pulls = [
-        p for p in typing.cast(list[PullRequest], r.json()) if p["state"] == "open"
+    check_for_graphql_errors(r)
+    return r.json()["data"]
+
+
+def get_pull_comments(node: typing.Any) -> list[Comment] | None:
+    if node["comments"]["pageInfo"]["hasNextPage"]:
+        return None
+    return [
+        Comment(
+            {
+                "url": f"issues/comments/{comment['fullDatabaseId']}",
+                "body": comment["body"],
+            }
+        )
+        for comment in node["comments"]["nodes"]
     ]
-    if len(pulls) > 1:
-        raise RuntimeError(f"More than 1 pull found with this head: {branch}")
-    if pulls:
-        return changeid, pulls[0]
-    return changeid, None
 
 
+async def get_known_changeids(
+    client: httpx.AsyncClient,
+    user: str,
+    repo: str,
+    stack_prefix: str,
+    refs: list[GitRef],
+    with_comments: bool,
+) -> tuple[KnownChangeIDs, KnownComments]:
+    stacked_ref_re = re.compile(
+        rf"^refs/heads/({re.escape(stack_prefix)}/(I[0-9a-z]{{40}}))$", re.ASCII
+    )
+    # This also skips the aio branch and any unrelated branch sharing the
+    # stack prefix
+    branches = [
+        typing.cast(tuple[str, ChangeId], m.groups())
+        for ref in refs
+        if (m := stacked_ref_re.match(ref["ref"]))
+    ]
+    known_changeids = KnownChangeIDs({})
+    known_comments = KnownComments({})
+    if not branches:
+        return known_changeids, known_comments
+
+    variables = {"owner": user, "repo": repo}
+    fields = []
+    for i, (branch, _) in enumerate(branches):
+        variables[f"h{i}"] = branch
+        fields.append(
+            PULLS_BY_HEAD_TEMPLATE
+            % (f"p{i}", f"h{i}", PULL_COMMENTS_FIELD if with_comments else "")
+        )
+    arguments = ", ".join(f"$h{i}: String!" for i in range(len(branches)))
+    query = (
+        f"query ($owner: String!, $repo: String!, {arguments}) "
+        f"{{ repository(owner: $owner, name: $repo) {{ {' '.join(fields)} }} }}"
+    )
+    data = await graphql(client, query, variables)
+
+    for i, (branch, changeid) in enumerate(branches):
+        # headRefName also matches pull requests opened from forks
+        nodes = [
+            node
+            for node in data["repository"][f"p{i}"]["nodes"]
+            if node["headRepositoryOwner"]
+            and node["headRepositoryOwner"]["login"].lower() == user.lower()
+        ]
+        if len(nodes) > 1:
+            raise RuntimeError(f"More than 1 pull found with this head: {branch}")
+        if nodes:
+            node = nodes[0]
+            if with_comments:
+                known_comments[node["number"]] = get_pull_comments(node)
+            known_changeids[changeid] = PullRequest(
+                {
+                    "html_url": node["url"],
+                    "number": node["number"],
+                    "title": node["title"],
+                    "head": {"sha": node["headRefOid"]},
+                    "base": {"ref": node["baseRefName"]},
+                    "state": node["state"].lower(),
+                    "draft": node["isDraft"],
+                    "node_id": node["id"],
+                }
+            )
+        else:
+            known_changeids[changeid] = None
+    return known_changeids, known_comments
+
+
+Commit = typing.NewType("Commit", tuple[str, str, str])
 Change = typing.NewType("Change", tuple[ChangeId, str, str, str])
 
 
+async def get_commits(base_commit_sha: str, dest_branch: str) -> list[Commit]:
+    # Fields are separated by NUL and records by RS
+    commits = []
+    async for record in git_stream(
+        "log",
+        "--format=%H%x00%s%x00%b%x1e",
+        f"{base_commit_sha}..{dest_branch}",
+        separator=b"\x1e",
+    ):
+        if not record:
+            continue
+        commit, title, message = record.split("\x00", 2)
+        commits.append(Commit((commit, title.strip(), message.strip())))
+    commits.reverse()
+    return commits
+
+
 async def get_local_changes(
-    commits: list[str],
+    commits: list[Commit],
     stack_prefix: str,
     known_changeids: KnownChangeIDs,
 ) -> list[Change]:
     changes = []
-    for i, commit in enumerate(commits):
-        message = await git(f"log -1 --format='%b' {commit}")
-        title = await git(f"log -1 --format='%s' {commit}")
+    for i, (commit, title, message) in enumerate(commits):
         changeids = CHANGEID_RE.findall(message)
         if not changeids:
             console.print(
@@ -212,7 +432,7 @@ async def get_local_changes(
 async def get_changeids_to_delete(
     changes: list[Change], known_changeids: KnownChangeIDs
 ) -> set[ChangeId]:
-    changeids_to_delete = set(known_changeids.keys()) - {
+    changeids_to_delete = known_changeids.keys() - {
         changeid for changeid, commit, title, message in changes
     }
     for changeid in changeids_to_delete:
@@ -228,131 +448,228 @@ async def get_changeids_to_delete(
     return changeids_to_delete
 
 
+async def create_or_update_comment(
+    client: httpx.AsyncClient,
+    pull: PullRequest,
+    body: str,
+    comments: list[Comment] | None,
+) -> None:
+    if comments is None:
+        comments = [
+            comment
+            async for comment in paginate(client, f"issues/{pull['number']}/comments")
+        ]
+    for comment in comments:
+        if comment["body"].startswith(STACK_COMMENT_FIRST_LINE):
+            if comment["body"] != body:
+                await client.patch(comment["url"], json={"body": body})
+            break
+    else:
+        await client.post(f"issues/{pull['number']}/comments", json={"body": body})
+
+
 async def create_or_update_comments(
-    client: httpx.AsyncClient, pulls: list[PullRequest]
+    client: httpx.AsyncClient,
+    pulls: list[PullRequest],
+    known_comments: KnownComments,
 ) -> None:
-    first_line = "This pull request is part of a stack:\n"
-    body = first_line
-    for pull in pulls:
-        body += f"1. {pull['title']} ([#{pull['number']}]({pull['html_url']}))\n"
+    body = STACK_COMMENT_FIRST_LINE + "".join(
+        f"1. {pull['title']} ([#{pull['number']}]({pull['html_url']}))\n"
+        for pull in pulls
+    )
+    await asyncio.gather(
+        *(
+            create_or_update_comment(
+                client, pull, body, known_comments.get(pull["number"])
+            )
+            for pull in pulls
+        )
+    )
 
-    for pull in pulls:
-        r = await client.get(f"issues/{pull['number']}/comments")
-        check_for_status(r)
-        for comment in r.json():
-            if comment["body"].startswith(first_line):
-                if comment["body"] != body:
-                    await client.patch(comment["url"], json={"body": body})
-                break
-        else:
-            await client.post(f"issues/{pull['number']}/comments", json={"body": body})
+
+async def create_or_update_branch(
+    client: httpx.AsyncClient,
+    stacked_dest_branch: str,
+    changeid: ChangeId,
+    commit: str,
+    known_changeids: KnownChangeIDs,
+) -> None:
+    if changeid in known_changeids:
+        r = await client.patch(
+            f"git/refs/heads/{stacked_dest_branch}",
+            json={"sha": commit, "force": True},
+        )
+    else:
+        r = await client.post(
+            "git/refs",
+            json={"ref": f"refs/heads/{stacked_dest_branch}", "sha": commit},
+        )
+    check_for_status(r)
 
 
-async def create_or_update_stack(
+async def create_or_update_pull(
     client: httpx.AsyncClient,
     stacked_base_branch: str,
     stacked_dest_branch: str,
-    changeid: ChangeId,
     commit: str,
     title: str,
     message: str,
     ready_for_review: bool,
-    known_changeids: KnownChangeIDs,
+    pull: PullRequest | None,
+    depends_on: PullRequest | asyncio.Task[tuple[PullRequest, str]] | None,
 ) -> tuple[PullRequest, str]:
-    if changeid in known_changeids:
-        pull = known_changeids.get(changeid)
-        with console.status(
-            f"* updating stacked branch `{stacked_dest_branch}` ({commit[-7:]}) - {pull['html_url'] if pull else '<stack branch without associated pull>'})"
-        ):
-            r = await client.patch(
-                f"git/refs/heads/{stacked_dest_branch}",
-                json={"sha": commit, "force": True},
-            )
-    else:
-        with console.status(
-            f"* creating stacked branch `{stacked_dest_branch}` ({commit[-7:]})"
-        ):
-            r = await client.post(
-                "git/refs",
-                json={"ref": f"refs/heads/{stacked_dest_branch}", "sha": commit},
-            )
-
-    check_for_status(r)
+    # The previous pull request is only awaited when it does not exist yet,
+    # as its number is needed
+    if isinstance(depends_on, asyncio.Task):
+        depends_on, _ = await depends_on
+    if depends_on is not None:
+        message += f"\n\nDepends-On: #{depends_on['number']}"
 
-    pull = known_changeids.get(changeid)
     if pull and pull["head"]["sha"] == commit:
         if ready_for_review and pull["draft"]:
             action = "ready_for_review"
-            r = await client.post(
-                "https://api.github.com/graphql",
-                headers={
-                    "Accept": "application/vnd.github.v4.idl",
-                    "User-Agent": f"git_push_stack/{VERSION}",
-                    "Authorization": client.headers["Authorization"],
-                },
-                json={"query": READY_FOR_REVIEW_TEMPLATE % pull["node_id"]},
-            )
-            check_for_status(r)
-            check_for_graphql_errors(r)
         else:
             action = "nothing"
     elif pull:
         action = "updated"
-        with console.status(
-            f"* updating pull request `{title}` (#{pull['number']}) ({commit[-7:]})"
-        ):
-            r = await client.patch(
-                f"pulls/{pull['number']}",
-                json={
-                    "title": title,
-                    "body": message,
-                    "head": stacked_dest_branch,
-                    "base": stacked_base_branch,
-                },
-            )
-            check_for_status(r)
-            pull = typing.cast(PullRequest, r.json())
-            if ready_for_review and pull["draft"]:
-                r = await client.post(
-                    "https://api.github.com/graphql",
-                    headers={
-                        "Accept": "application/vnd.github.v4.idl",
-                        "User-Agent": f"git_push_stack/{VERSION}",
-                        "Authorization": client.headers["Authorization"],
-                    },
-                    json={"query": READY_FOR_REVIEW_TEMPLATE % pull["node_id"]},
-                )
-                check_for_status(r)
-                check_for_graphql_errors(r)
+        r = await client.patch(
+            f"pulls/{pull['number']}",
+            json={
+                "title": title,
+                "body": message,
+                "head": stacked_dest_branch,
+                "base": stacked_base_branch,
+            },
+        )
+        check_for_status(r)
+        pull = typing.cast(PullRequest, r.json())
     else:
         action = "created"
-        with console.status(
-            f"* creating stacked pull request `{title}` ({commit[-7:]})"
-        ):
-            r = await client.post(
-                "pulls",
-                json={
-                    "title": title,
-                    "body": message,
-                    "draft": not ready_for_review,
-                    "head": stacked_dest_branch,
-                    "base": stacked_base_branch,
-                },
-            )
-            check_for_status(r)
-            pull = typing.cast(PullRequest, r.json())
+        r = await client.post(
+            "pulls",
+            json={
+                "title": title,
+                "body": message,
+                "draft": not ready_for_review,
+                "head": stacked_dest_branch,
+                "base": stacked_base_branch,
+            },
+        )
+        check_for_status(r)
+        pull = typing.cast(PullRequest, r.json())
     return pull, action
 
 
+def is_stack_retargeted(
+    base_branch: str,
+    stack_prefix: str,
+    changes: list[Change],
+    known_changeids: KnownChangeIDs,
+) -> bool:
+    stacked_base_branch = base_branch
+    for changeid, _, _, _ in changes:
+        pull = known_changeids.get(changeid)
+        if pull and pull["base"]["ref"] != stacked_base_branch:
+            return True
+        stacked_base_branch = f"{stack_prefix}/{changeid}"
+    return False
+
+
+async def create_or_update_stack_serially(
+    client: httpx.AsyncClient,
+    base_branch: str,
+    stack_prefix: str,
+    changes: list[Change],
+    known_changeids: KnownChangeIDs,
+) -> list[tuple[PullRequest, str]]:
+    results: list[tuple[PullRequest, str]] = []
+    stacked_base_branch = base_branch
+    for changeid, commit, title, message in changes:
+        stacked_dest_branch = f"{stack_prefix}/{changeid}"
+        await create_or_update_branch(
+            client, stacked_dest_branch, changeid, commit, known_changeids
+        )
+        results.append(
+            await create_or_update_pull(
+                client,
+                stacked_base_branch,
+                stacked_dest_branch,
+                commit,
+                title,
+                message,
+                not results,
+                known_changeids.get(changeid),
+                results[-1][0] if results else None,
+            )
+        )
+        stacked_base_branch = stacked_dest_branch
+    return results
+
+
+async def create_or_update_stack_concurrently(
+    client: httpx.AsyncClient,
+    base_branch: str,
+    stack_prefix: str,
+    changes: list[Change],
+    known_changeids: KnownChangeIDs,
+) -> list[tuple[PullRequest, str]]:
+    await asyncio.gather(
+        *(
+            create_or_update_branch(
+                client, f"{stack_prefix}/{changeid}", changeid, commit, known_changeids
+            )
+            for changeid, commit, title, message in changes
+        )
+    )
+
+    pull_tasks: list[asyncio.Task[tuple[PullRequest, str]]] = []
+    stacked_base_branch = base_branch
+    depends_on: PullRequest | asyncio.Task[tuple[PullRequest, str]] | None = None
+    for changeid, commit, title, message in changes:
+        stacked_dest_branch = f"{stack_prefix}/{changeid}"
+        pull = known_changeids.get(changeid)
+        task = asyncio.create_task(
+            create_or_update_pull(
+                client,
+                stacked_base_branch,
+                stacked_dest_branch,
+                commit,
+                title,
+                message,
+                not pull_tasks,
+                pull,
+                depends_on,
+            )
+        )
+        pull_tasks.append(task)
+        depends_on = pull or task
+        stacked_base_branch = stacked_dest_branch
+    return await asyncio.gather(*pull_tasks)
+
+
+async def mark_pulls_ready_for_review(
+    client: httpx.AsyncClient, pulls: list[PullRequest]
+) -> None:
+    if not pulls:
+        return
+    mutations = " ".join(
+        READY_FOR_REVIEW_TEMPLATE % (f"m{i}", pull["node_id"])
+        for i, pull in enumerate(pulls)
+    )
+    await graphql(client, f"mutation {{ {mutations} }}")
+
+
 async def delete_stack(
     client: httpx.AsyncClient,
     stack_prefix: str,
     changeid: ChangeId,
     known_changeids: KnownChangeIDs,
+    semaphore: asyncio.Semaphore,
 ) -> None:
-    r = await client.delete(
-        f"git/refs/heads/{stack_prefix}/{changeid}",
-    )
+    async with semaphore:
+        r = await client.delete(
+            f"git/refs/heads/{stack_prefix}/{changeid}",
+        )
     check_for_status(r)
     pull = known_changeids[changeid]
     if pull:
@@ -381,12 +698,17 @@ async def log_httpx_response(response: httpx.Response) -> None:
 async def main(
     token: str, stack: bool, next_only: bool, branch_prefix: str, dry_run: bool
 ) -> None:
-    os.chdir((await git("rev-parse --show-toplevel")).strip())
-    dest_branch = await git("rev-parse --abbrev-ref HEAD")
+    toplevel, dest_branch = await asyncio.gather(
+        git("rev-parse", "--show-toplevel"),
+        git("rev-parse", "--abbrev-ref", "HEAD"),
+    )
+    os.chdir(toplevel)
     remote, _, base_branch = (
-        await git(f"for-each-ref --format='%(upstream:short)' refs/heads/{dest_branch}")
+        await git(
+            "for-each-ref", "--format=%(upstream:short)", f"refs/heads/{dest_branch}"
+        )
     ).partition("/")
-    user, repo = get_slug(await git(f"config --get remote.{remote}.url"))
+    user, repo = get_slug(await git("config", "--get", f"remote.{remote}.url"))
 
     if base_branch == dest_branch:
         console.log("[red] base branch and destination branch are the same [/]")
@@ -398,16 +720,16 @@ async def main(
         with console.status(
             f"Rebasing branch `{dest_branch}` on `{remote}/{base_branch}`...",
         ):
-            await git(f"pull --rebase {remote} {base_branch}")
+            await git("pull", "--rebase", remote, base_branch)
         console.log(f"branch `{dest_branch}` rebased on `{remote}/{base_branch}`")
 
         with console.status(
             f"Pushing branch `{dest_branch}` to `{remote}/{dest_branch}`...",
         ):
-            await git(f"push -f {remote} {dest_branch}:{stack_prefix}/aio")
+            await git("push", "-f", remote, f"{dest_branch}:{stack_prefix}/aio")
         console.log(f"branch `{dest_branch}` pushed to `{remote}/{dest_branch}` ")
 
-    base_commit_sha = await git(f"merge-base --fork-point {remote}/{base_branch}")
+    base_commit_sha = await git("merge-base", "--fork-point", f"{remote}/{base_branch}")
     if not base_commit_sha:
         console.log(
             f"Common commit between `{remote}/{base_branch}` and `{dest_branch}` branches not found",
@@ -415,22 +737,12 @@ async def main(
         )
         sys.exit(1)
 
-    commits = [
-        commit
-        for commit in reversed(
-            (await git(f"log --format='%H' {base_commit_sha}..{dest_branch}")).split(
-                "\n"
-            )
-        )
-        if commit.strip()
-    ]
+    commits = await get_commits(base_commit_sha, dest_branch)
 
     if len(commits) > 1 and not stack:
         console.log("[red] too many commits and stack mode disabled [/]")
         sys.exit(1)
 
-    known_changeids = KnownChangeIDs({})
-
     if DEBUG:
         event_hooks = {"request": [log_httpx_request], "response": [log_httpx_response]}
     else:
@@ -444,21 +756,24 @@ async def main(
             "Authorization": f"token {token}",
         },
         event_hooks=event_hooks,  # type: ignore[arg-type]
+        transport=RateLimitRetryTransport(
+            httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_keepalive_connections=50,
+                    max_connections=50,
+                    keepalive_expiry=30.0,
+                )
+            )
+        ),
+        timeout=httpx.Timeout(30.0),
     ) as client:
         with console.status("Retrieving latest pushed stacks"):
             r = await client.get(f"git/matching-refs/heads/{stack_prefix}/")
             check_for_status(r)
             refs = typing.cast(list[GitRef], r.json())
-
-            tasks = [
-                get_changeid_and_pull(client, user, stack_prefix, ref)
-                for ref in refs
-                if not ref["ref"].endswith("/aio")
-            ]
-            if tasks:
-                done, _ = await asyncio.wait(tasks)
-                for task in done:
-                    known_changeids.update(dict([await task]))
+            known_changeids, known_comments = await get_known_changeids(
+                client, user, repo, stack_prefix, refs, stack
+            )
 
         with console.status("Preparing stacked branches..."):
             console.log("Stacked pull request plan:", style="green")
@@ -472,28 +787,33 @@ async def main(
             sys.exit(0)
 
         console.log("New stacked pull request:", style="green")
-        stacked_base_branch = base_branch
-        ready_for_review = True
-        pulls: list[PullRequest] = []
-        continue_create_or_update = True
-        for changeid, commit, title, message in changes:
-            depends_on = ""
-            if pulls:
-                depends_on = f"\n\nDepends-On: #{pulls[-1]['number']}"
-            stacked_dest_branch = f"{stack_prefix}/{changeid}"
-            if continue_create_or_update:
-                pull, action = await create_or_update_stack(
-                    client,
-                    stacked_base_branch,
-                    stacked_dest_branch,
-                    changeid,
-                    commit,
-                    title,
-                    message + depends_on,
-                    ready_for_review,
-                    known_changeids,
-                )
-                pulls.append(pull)
+        changes_to_push = changes[:1] if next_only else changes
+
+        with console.status("Creating or updating stacked pull requests..."):
+            # Pushing a stacked branch before retargeting the pull request
+            # that used it as base can make GitHub consider that pull request
+            # merged, so reordered stacks are pushed one change at a time
+            if is_stack_retargeted(
+                base_branch, stack_prefix, changes_to_push, known_changeids
+            ):
+                create_or_update_stack = create_or_update_stack_serially
+            else:
+                create_or_update_stack = create_or_update_stack_concurrently
+            results = await create_or_update_stack(
+                client, base_branch, stack_prefix, changes_to_push, known_changeids
+            )
+            # Only the bottom of the stack is ready for review
+            await mark_pulls_ready_for_review(
+                client, [pull for pull, action in results[:1] if pull["draft"]]
+            )
+
+        pulls = [pull for pull, action in results]
+        for pull, action in results:
+            if action == "created":
+                known_comments[pull["number"]] = []
+        for i, (changeid, commit, _, _) in enumerate(changes):
+            if i < len(results):
+                pull, action = results[i]
             else:
                 action = "skipped"
                 pull = known_changeids.get(changeid) or PullRequest(
@@ -505,29 +825,28 @@ async def main(
                         "draft": True,
                         "state": "",
                         "head": {"sha": ""},
+                        "base": {"ref": ""},
                     }
                 )
-
             console.log(
                 f"* [blue]\\[{action}][/] '[red]{commit[-7:]}[/] - [b]{pull['title']}[/] {pull['html_url']} - {changeid}"
             )
-            stacked_base_branch = stacked_dest_branch
-            ready_for_review = False
-            if continue_create_or_update and next_only:
-                continue_create_or_update = False
 
         if stack:
             with console.status("Updating comments..."):
-                await create_or_update_comments(client, pulls)
+                await create_or_update_comments(client, pulls, known_comments)
             console.log("[green]Comments updated")
 
         with console.status("Deleting unused branches..."):
-            delete_tasks = [
-                delete_stack(client, stack_prefix, changeid, known_changeids)
-                for changeid in changeids_to_delete
-            ]
-            if delete_tasks:
-                await asyncio.wait(delete_tasks)
+            semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+            await asyncio.gather(
+                *(
+                    delete_stack(
+                        client, stack_prefix, changeid, known_changeids, semaphore
+                    )
+                    for changeid in changeids_to_delete
+                )
+            )
 
         console.log("[green]Finished :tada:[/]")
 
@@ -541,7 +860,7 @@ def GitHubToken(v: str) -> str:
 def get_default_branch_prefix() -> str:
     try:
         result = subprocess.check_output(
-            "git config --get git-push-stack.branch-prefix", shell=True
+            ["git", "config", "--get", "git-push-stack.branch-prefix"]
         )
     except subprocess.CalledProcessError:
         result = b""